@@ -1,135 +1,528 @@
 import os
-import cv2
+import sys
+import platform
 import moondream as md
 import replicate
 import requests
-from PIL import Image
-from moviepy.editor import VideoFileClip, concatenate_videoclips, AudioFileClip
 from pathlib import Path
 from dotenv import load_dotenv
 import time
 import subprocess
 import json
+import shutil
+import threading
+import base64
+import io
+import mmap
+import atexit
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables from .env file
 load_dotenv()
 
 class VideoProcessor:
-    def __init__(self, moondream_api_key, replicate_api_token):
+    def __init__(self, moondream_api_key, replicate_api_token, max_workers=None, replicate_concurrency=5,
+                 moondream_concurrency=2, fragmented_output=False):
         """Initialize the video processor with necessary API keys."""
         self.moondream_model = md.vl(api_key=moondream_api_key)
         os.environ["REPLICATE_API_TOKEN"] = replicate_api_token
         
-        # Create input and output directories if they don't exist
+        # Number of videos run through FFmpeg concurrently (defaults to CPU count)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        # Limit on Replicate predictions in flight at once across all videos
+        self.replicate_slots = threading.BoundedSemaphore(replicate_concurrency)
+        # Limit on Moondream requests in flight, which the API pool would
+        # otherwise send one per video all at once
+        self.moondream_slots = threading.BoundedSemaphore(moondream_concurrency)
+        # Serialize console output so concurrent videos don't interleave mid-line
+        self.print_lock = threading.Lock()
+        # +faststart rewrites the whole file once to move the index to the front;
+        # fragmented output skips that pass, but players can't seek it or show
+        # its duration until they've read the fragments
+        self.output_movflags = self.FRAGMENTED_MOVFLAGS if fragmented_output else '+faststart'
+        
+        # Reuse HTTP connections across downloads from the same CDN host
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32)
+        self.session.mount('https://', adapter)
+        
+        # Prefer a hardware H.264 encoder for re-encodes when one works here
+        self.h264_encoder = self.detect_h264_encoder()
+        self.log(f"Using H.264 encoder: {self.h264_encoder}")
+        
+        # Create input, output and temp directories if they don't exist
         self.input_dir = Path("input")
         self.output_dir = Path("output")
-        self.temp_dir = Path("temp")
-        for dir in [self.input_dir, self.output_dir, self.temp_dir]:
+        self.local_temp_dir = Path("temp")
+        for dir in [self.input_dir, self.output_dir, self.local_temp_dir]:
             dir.mkdir(exist_ok=True)
+        # Intermediates go to the system temp directory, or ./temp if that fails
+        # or is itself RAM-backed (Fedora and Arch mount /tmp as tmpfs); the
+        # small generated-clip files use RAM-backed /dev/shm while it has room
+        base = self.local_temp_dir if self.is_ram_backed(tempfile.gettempdir()) else None
+        self.temp_dir = self.create_temp_dir(base) or self.local_temp_dir
+        self.ram_temp_dir = None
+        if sys.platform.startswith('linux') and os.path.ismount('/dev/shm'):
+            self.ram_temp_dir = self.create_temp_dir('/dev/shm')
+        self.ram_reserved = 0
+        self.ram_lock = threading.Lock()
+
+    def log(self, message=""):
+        """Print a message without interleaving output from other worker threads."""
+        with self.print_lock:
+            print(message)
+
+    # RAM budget per video for the generated clip, its audio and their muxes
+    RAM_BYTES_PER_VIDEO = 256 * 1024 * 1024
+
+    def create_temp_dir(self, base=None):
+        """Create a scratch directory that is removed on exit, or return None if that fails."""
+        # base=None uses the system temp directory (/tmp on Linux and macOS,
+        # %TEMP% on Windows)
+        try:
+            temp_dir = Path(tempfile.mkdtemp(dir=base, prefix='videogen-'))
+        except OSError:
+            return None
+        atexit.register(shutil.rmtree, temp_dir, ignore_errors=True)
+        return temp_dir
+
+    def is_ram_backed(self, path):
+        """Check whether a path is on a tmpfs or ramfs mount (Linux only)."""
+        if not sys.platform.startswith('linux'):
+            return False
+        path = os.path.realpath(path)
+        fstype, longest = None, ''
+        try:
+            with open('/proc/mounts') as f:
+                for line in f:
+                    fields = line.split()
+                    # Spaces in mount points are escaped as \040
+                    mount_point = fields[1].replace('\\040', ' ')
+                    under = path == mount_point or path.startswith(mount_point.rstrip('/') + '/')
+                    # The last, most specific mount containing the path wins
+                    if under and len(mount_point) >= len(longest):
+                        longest, fstype = mount_point, fields[2]
+        except OSError:
+            return False
+        return fstype in ('tmpfs', 'ramfs')
+
+    def reserve_scratch_dirs(self, job):
+        """Choose where a video's intermediate files go, based on free space.
+        
+        Sets job["temp_dir"] for the generated clip and its muxes, which uses
+        /dev/shm when the RAM budget fits, and job["original_temp_dir"] for
+        the remuxed copy of the input, which is always kept on disk.
+        """
+        # The remuxed original is about the size of the input; keep some headroom
+        needed = Path(job["input_video_path"]).stat().st_size * 2
+        disk_base = self.temp_dir
+        if shutil.disk_usage(disk_base).free < needed:
+            disk_base = self.local_temp_dir
+        job["original_temp_dir"] = disk_base / job["output_base"].name
+        
+        # Concurrent videos haven't written their files yet, so count their
+        # reservations rather than relying on the current free space alone
+        job["ram_reserved"] = False
+        if self.ram_temp_dir:
+            with self.ram_lock:
+                free = shutil.disk_usage(self.ram_temp_dir).free - self.ram_reserved
+                if free >= self.RAM_BYTES_PER_VIDEO:
+                    self.ram_reserved += self.RAM_BYTES_PER_VIDEO
+                    job["ram_reserved"] = True
+        temp_base = self.ram_temp_dir if job["ram_reserved"] else disk_base
+        job["temp_dir"] = temp_base / job["output_base"].name
+        job["temp_dir"].mkdir(parents=True, exist_ok=True)
+
+    def release_scratch_dirs(self, job):
+        """Return a video's RAM reservation once its intermediates are gone."""
+        with self.ram_lock:
+            if job.get("ram_reserved"):
+                self.ram_reserved -= self.RAM_BYTES_PER_VIDEO
+                job["ram_reserved"] = False
+
+    def url_is_available(self, url):
+        """Check whether a previously generated URL can still be downloaded."""
+        try:
+            response = self.session.head(url, allow_redirects=True, timeout=10)
+            return response.status_code == 200
+        except requests.RequestException:
+            return False
+
+    def load_state(self, state_path, input_video_path):
+        """Load the saved pipeline state for a video, ignoring it if the input has changed."""
+        stat = Path(input_video_path).stat()
+        source = {"size": stat.st_size, "mtime": stat.st_mtime}
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            state = {}
+        if state.get("source") != source:
+            state = {"source": source}
+        return state
+
+    def save_state(self, state_path, state):
+        """Write the pipeline state for a video so a later run can resume from it."""
+        with open(state_path, 'w') as f:
+            json.dump(state, f, indent=2)
 
     def download_file(self, url, output_path):
         """Download a file from a URL to the specified path."""
-        print(f"   Downloading file from {url[:60]}...")
-        response = requests.get(url, stream=True)
+        self.log(f"   Downloading file from {url[:60]}...")
+        response = self.session.get(url, stream=True, timeout=30)
         response.raise_for_status()
         
+        # Copy the raw stream in 1 MiB blocks to keep per-chunk Python overhead low
+        response.raw.decode_content = True
         with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        print(f"   Downloaded to {output_path}")
+            shutil.copyfileobj(response.raw, f, length=1 << 20)
+        self.log(f"   Downloaded to {output_path}")
         return output_path
 
+    FRAGMENTED_MOVFLAGS = '+frag_keyframe+empty_moov+default_base_moof'
+
+    # Encoder-specific flags roughly equivalent to libx264 -preset medium -crf 23.
+    # VideoToolbox only supports -q:v on Apple Silicon, so Intel Macs use a bitrate
+    H264_ENCODER_ARGS = {
+        'h264_videotoolbox': ['-q:v', '65'] if platform.machine() == 'arm64' else ['-b:v', '8M'],
+        'h264_nvenc': ['-preset', 'p5', '-rc', 'vbr', '-cq', '23', '-b:v', '0'],
+        'h264_qsv': ['-preset', 'medium', '-global_quality', '23'],
+        'libx264': ['-preset', 'medium', '-crf', '23'],
+    }
+
+    # Rate/profile limits used by the full re-encode fallback
+    REENCODE_LIMIT_ARGS = [
+        '-profile:v', 'high',
+        '-level:v', '4.0',
+        '-maxrate', '10M',
+        '-bufsize', '20M',
+    ]
+
+    def detect_h264_encoder(self):
+        """Return the first hardware H.264 encoder that works, falling back to libx264."""
+        try:
+            result = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-encoders'],
+                capture_output=True, text=True, check=True
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return 'libx264'
+        
+        for encoder in ['h264_videotoolbox', 'h264_nvenc', 'h264_qsv']:
+            if encoder not in result.stdout:
+                continue
+            # Being compiled in doesn't mean the hardware is present (or that it
+            # accepts our flags), so try encoding a frame with the real settings
+            test = subprocess.run(
+                ['ffmpeg', '-hide_banner', '-v', 'error',
+                 '-f', 'lavfi', '-i', 'color=black:size=256x256:duration=0.1',
+                 '-frames:v', '1',
+                 *self.h264_encoder_args(encoder),
+                 *self.REENCODE_LIMIT_ARGS,
+                 '-f', 'null', '-'],
+                capture_output=True
+            )
+            if test.returncode == 0:
+                return encoder
+        return 'libx264'
+
+    def h264_encoder_args(self, encoder=None):
+        """Return the FFmpeg video codec flags for an H.264 encoder (the selected one by default)."""
+        encoder = encoder or self.h264_encoder
+        return ['-c:v', encoder] + self.H264_ENCODER_ARGS[encoder]
+
+    def start_ffmpeg(self, command):
+        """Start an FFmpeg command in the background and return its process."""
+        # Several FFmpeg processes can run at once, so don't print progress
+        # stats; warnings go to a temp file and are logged only on failure
+        command[1:1] = ['-nostats', '-v', 'warning']
+        stderr = tempfile.TemporaryFile()
+        process = subprocess.Popen(command, stderr=stderr)
+        process.stderr_file = stderr
+        return process
+
+    def wait_ffmpeg(self, process):
+        """Wait for an FFmpeg process to finish and report whether it succeeded."""
+        returncode = process.wait()
+        with process.stderr_file as stderr:
+            stderr.seek(0)
+            output = stderr.read().decode(errors='replace').strip()
+        if returncode != 0:
+            self.log(f"FFmpeg error: Command '{process.args}' returned non-zero exit status {returncode}."
+                     + (f"\n{output}" if output else ""))
+            return False
+        return True
+
     def run_ffmpeg(self, command):
         """Run an FFmpeg command and handle errors."""
-        try:
-            # Add progress stats to the command
-            command.extend(['-stats', '-v', 'warning'])
-            # Don't capture output so we can see progress in real-time
-            result = subprocess.run(command, check=True)
-            return True
-        except subprocess.CalledProcessError as e:
-            print(f"FFmpeg error: {str(e)}")
+        return self.wait_ffmpeg(self.start_ffmpeg(command))
+
+    def probe_streams(self, media_path):
+        """Return the stream details ffprobe reports for a media file."""
+        cmd = [
+            'ffprobe',
+            '-v', 'error',
+            '-show_entries',
+            'stream=codec_type,codec_name,profile,level,width,height,pix_fmt,'
+            'sample_aspect_ratio,r_frame_rate,sample_rate,channels,channel_layout',
+            '-of', 'json',
+            str(media_path)
+        ]
+        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        return json.loads(result.stdout).get('streams', [])
+
+    def can_concat_without_reencoding(self, first_path, second_path):
+        """Check whether two videos share the codec parameters needed for stream-copy concat."""
+        video_keys = ['codec_name', 'profile', 'width', 'height', 'pix_fmt',
+                      'sample_aspect_ratio', 'r_frame_rate']
+        audio_keys = ['codec_name', 'sample_rate', 'channels']
+
+        def signature(streams):
+            video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+            audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+            if video is None or audio is None:
+                return None
+            return (
+                tuple(video.get(k) for k in video_keys),
+                tuple(audio.get(k) for k in audio_keys)
+            )
+
+        first = signature(self.probe_streams(first_path))
+        second = signature(self.probe_streams(second_path))
+        return first is not None and first == second
+
+    def concat_videos(self, video_paths, output_path, list_path):
+        """Concatenate videos with the FFmpeg concat demuxer, copying streams as-is."""
+        with open(list_path, 'w') as f:
+            for path in video_paths:
+                # Paths in the concat list are single-quoted
+                escaped = str(Path(path).resolve()).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        cmd = [
+            'ffmpeg', '-y',
+            '-f', 'concat',
+            '-safe', '0',
+            '-i', str(list_path),
+            '-c', 'copy',
+            '-movflags', self.output_movflags,
+            str(output_path)
+        ]
+        return self.run_ffmpeg(cmd)
+
+    def normalize_for_concat(self, video_path, reference_path, output_path):
+        """Re-encode a video to match a reference H.264 video's stream parameters.
+        
+        Returns False without encoding when the reference can't be matched
+        with an H.264 encoder, so the caller can fall back to a full re-encode.
+        """
+        streams = self.probe_streams(reference_path)
+        video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+        audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+        if video is None or audio is None or video.get('codec_name') != 'h264':
             return False
+        profile = (video.get('profile') or '').lower().replace('constrained ', '')
+        if profile not in ('baseline', 'main', 'high'):
+            return False
+        
+        self.log("   Normalizing generated video to match the original...")
+        # Hardware encoders may reject the original's profile, level or pixel
+        # format, so retry once with libx264 before giving up
+        encoders = [self.h264_encoder] if self.h264_encoder == 'libx264' else [self.h264_encoder, 'libx264']
+        for encoder in encoders:
+            cmd = [
+                'ffmpeg', '-y',
+                '-i', str(video_path),
+                '-vf', f"scale={video['width']}:{video['height']},setsar=1:1,fps={video['r_frame_rate']}",
+                *self.h264_encoder_args(encoder),
+                '-profile:v', profile,
+                '-pix_fmt', video['pix_fmt'],
+                '-g', '60',
+            ]
+            if (video.get('level') or 0) > 0:
+                cmd.extend(['-level:v', f"{video['level'] / 10:.1f}"])
+            cmd.extend([
+                '-c:a', 'aac',
+                '-b:a', '192k',
+                '-ar', str(audio['sample_rate']),
+                '-ac', str(audio['channels']),
+                str(output_path)
+            ])
+            if self.run_ffmpeg(cmd):
+                return True
+            if encoder != 'libx264':
+                self.log(f"   {encoder} failed, retrying with libx264...")
+        return False
 
-    def extract_final_frame(self, video_path):
+    def extract_final_frame(self, video_path, output_name=None):
         """Extract the final frame from the video."""
-        print("   Opening video file...")
-        cap = cv2.VideoCapture(str(video_path))
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        print(f"   Video has {total_frames} frames, extracting last frame...")
-        cap.set(cv2.CAP_PROP_POS_FRAMES, total_frames - 1)
-        ret, frame = cap.read()
-        cap.release()
+        output_name = output_name or Path(video_path).stem
+        frame_path = self.output_dir / f"{output_name}_final_frame.jpg"
+        if frame_path.exists():
+            frame_path.unlink()
+        
+        # Seek relative to the end of the file so only the last few seconds are
+        # decoded; -update keeps overwriting the image, leaving the final frame
+        self.log("   Extracting last frame with FFmpeg...")
+        cmd = [
+            'ffmpeg', '-y',
+            '-sseof', '-3',
+            '-i', str(video_path),
+            '-update', '1',
+            '-q:v', '2',
+            str(frame_path)
+        ]
+        if self.run_ffmpeg(cmd) and frame_path.exists():
+            return frame_path
         
-        if ret:
-            frame_path = self.output_dir / f"{Path(video_path).stem}_final_frame.jpg"
-            # Save directly in BGR format without color conversion
-            cv2.imwrite(str(frame_path), frame)
+        # Some containers can't seek from the end, so seek from the start instead
+        self.log("   Seeking from end failed, retrying using the video duration...")
+        cmd = [
+            'ffprobe',
+            '-v', 'error',
+            '-show_entries', 'format=duration',
+            '-of', 'json',
+            str(video_path)
+        ]
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            duration = float(json.loads(result.stdout)['format']['duration'])
+        except (subprocess.CalledProcessError, KeyError, ValueError) as e:
+            self.log(f"   Error reading video duration: {str(e)}")
+            return None
+        cmd = [
+            'ffmpeg', '-y',
+            '-ss', f"{max(duration - 0.1, 0):.3f}",
+            '-i', str(video_path),
+            '-update', '1',
+            '-q:v', '2',
+            str(frame_path)
+        ]
+        if self.run_ffmpeg(cmd) and frame_path.exists():
             return frame_path
         return None
 
     def analyze_frame(self, frame_path):
         """Analyze the frame using Moondream and generate a scenario."""
-        print("   Loading image for analysis...")
-        image = Image.open(frame_path)
-        print("   Encoding image with Moondream...")
-        encoded_image = self.moondream_model.encode_image(image)
+        from PIL import Image
         
-        print("   Generating scenario from image...")
+        self.log("   Loading image for analysis...")
+        image = Image.open(frame_path)
+        # Moondream works on small crops internally, so full-resolution frames
+        # only add pixel work and upload size
+        image.thumbnail((768, 768), Image.Resampling.LANCZOS)
         prompt = "Describe a surreal, mind-bending scenario that could happen in this scene. Make it visually spectacular and impossible in real life, like something from a viral video that would break the internet. Focus on unexpected transformations, physics-defying events, or magical occurrences."
-        scenario = self.moondream_model.query(encoded_image, prompt)["answer"]
+        with self.moondream_slots:
+            self.log("   Encoding image with Moondream...")
+            encoded_image = self.moondream_model.encode_image(image)
+            
+            self.log("   Generating scenario from image...")
+            scenario = self.moondream_model.query(encoded_image, prompt)["answer"]
         return scenario
 
-    def upload_image(self, image_path):
-        """Convert image to base64 data URI."""
+    def upload_image(self, image_path, max_size=1280):
+        """Convert image to base64 data URI, downscaling it if it's larger than needed."""
+        from PIL import Image
+        
         try:
-            print("   Converting image to base64...")
-            with open(image_path, 'rb') as f:
-                import base64
-                image_data = f.read()
-                base64_data = base64.b64encode(image_data).decode('utf-8')
-                mime_type = 'image/jpeg' if str(image_path).lower().endswith('.jpg') or str(image_path).lower().endswith('.jpeg') else 'image/png'
-                return f"data:{mime_type};base64,{base64_data}"
+            self.log("   Converting image to base64...")
+            image_path = str(image_path)
+            mime_type = 'image/jpeg' if image_path.lower().endswith('.jpg') or image_path.lower().endswith('.jpeg') else 'image/png'
+            
+            with Image.open(image_path) as image:
+                needs_resize = max(image.size) > max_size
+                if needs_resize:
+                    # Minimax doesn't need more than ~720p input, so send fewer bytes
+                    image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+                    buffer = io.BytesIO()
+                    image.save(buffer, format='JPEG', quality=90)
+                    mime_type = 'image/jpeg'
+                    encoded = base64.b64encode(buffer.getbuffer())
+            if not needs_resize:
+                # Encode straight from a memory map of the file without reading it in first
+                with open(image_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    encoded = base64.b64encode(mm)
+            
+            # Build the data URI as bytes and decode once at the end
+            data_uri = f"data:{mime_type};base64,".encode('ascii') + encoded
+            return data_uri.decode('ascii')
         except Exception as e:
-            print(f"   Error converting image to base64: {str(e)}")
+            self.log(f"   Error converting image to base64: {str(e)}")
             return None
 
+    # Consecutive failed status checks before giving up on a prediction
+    MAX_POLL_FAILURES = 5
+
+    def run_prediction(self, model, input):
+        """Create a Replicate prediction and poll it with exponential backoff until it finishes."""
+        with self.replicate_slots:
+            if ':' in model:
+                version = model.split(':', 1)[1]
+                prediction = replicate.predictions.create(version=version, input=input)
+            else:
+                prediction = replicate.models.predictions.create(model=model, input=input)
+            
+            attempt = 0
+            failures = 0
+            last_update = time.time()
+            try:
+                while prediction.status not in ('succeeded', 'failed', 'canceled'):
+                    # Poll quickly at first, backing off to every 10 seconds
+                    time.sleep(min(10, 1.5 ** attempt))
+                    attempt += 1
+                    try:
+                        prediction.reload()
+                        failures = 0
+                    except Exception as e:
+                        # A dropped connection or 5xx shouldn't lose a paid
+                        # prediction, so keep polling unless it keeps failing
+                        failures += 1
+                        if failures >= self.MAX_POLL_FAILURES:
+                            raise
+                        self.log(f"   Error checking prediction {prediction.id}, retrying: {str(e)}")
+                        continue
+                    # Update every 30 seconds
+                    if time.time() - last_update >= 30:
+                        self.log(f"   Still generating ({prediction.status})...")
+                        last_update = time.time()
+            except BaseException:
+                # Don't leave the prediction running (and billing) if we stop
+                # waiting for it, including on Ctrl+C
+                try:
+                    prediction.cancel()
+                except BaseException:
+                    pass
+                raise
+        
+        if prediction.status != 'succeeded':
+            raise Exception(f"Prediction {prediction.id} {prediction.status}: {prediction.error}")
+        return prediction.output
+
     def generate_video(self, frame_path, scenario):
         """Generate a video using Minimax based on the frame and scenario."""
         # First convert image to base64
-        print("   Converting image to base64...")
+        self.log("   Converting image to base64...")
         frame_url = self.upload_image(frame_path)
         if not frame_url:
             raise Exception("Failed to convert frame to data URI")
             
         # Now start the video generation with progress updates
-        print("\n   Running prediction...")
-        print(f"   Initializing video generation with prompt: {scenario[:100]}...")
-        print("   Generating video...")
+        self.log("\n   Running prediction...")
+        self.log(f"   Initializing video generation with prompt: {scenario[:100]}...")
+        self.log("   Generating video...")
         
         start_time = time.time()
-        last_update = start_time
-        
-        def prediction_callback(event_data):
-            nonlocal last_update
-            current_time = time.time()
-            # Update every 30 seconds
-            if current_time - last_update >= 30:
-                print("   Still generating...")
-                last_update = current_time
-        
-        output = replicate.run(
+        output = self.run_prediction(
             "minimax/video-01",
             input={
                 "prompt": scenario,
                 "prompt_optimizer": True,
                 "first_frame_image": frame_url
-            },
-            callback=prediction_callback
+            }
         )
         
         total_time = time.time() - start_time
-        print(f"   Generated video in {total_time:.1f} seconds")
+        self.log(f"   Generated video in {total_time:.1f} seconds")
         
         # Extract URL from output
         if hasattr(output, 'output_url'):
@@ -139,14 +532,14 @@ class VideoProcessor:
         else:
             video_url = str(output)
             
-        print(f"   Video generated: {video_url[:100]}")
+        self.log(f"   Video generated: {video_url[:100]}")
         return video_url
 
     def generate_audio(self, video_url):
         """Generate audio for the video using MMAudio."""
-        print("   Sending request to MMAudio model...")
-        print("   This may take a few minutes...")
-        output = replicate.run(
+        self.log("   Sending request to MMAudio model...")
+        self.log("   This may take a few minutes...")
+        output = self.run_prediction(
             "zsxkib/mmaudio:4b9f801a167b1f6cc2db6ba7ffdeb307630bf411841d4e8300e63ca992de0be9",
             input={
                 "video": str(video_url),
@@ -158,7 +551,7 @@ class VideoProcessor:
                 "seed": -1
             }
         )
-        print("   Audio generation complete")
+        self.log("   Audio generation complete")
         
         # Extract URL from output
         if hasattr(output, 'output_url'):
@@ -168,193 +561,384 @@ class VideoProcessor:
         else:
             audio_url = str(output)
             
-        print(f"   Audio generated: {audio_url[:100]}")
+        self.log(f"   Audio generated: {audio_url[:100]}")
         return audio_url
 
-    def combine_videos(self, original_video_path, generated_video_url, audio_url, output_base):
-        """Download generated content and combine everything into final video."""
+    def combine_videos(self, original_video_path, gen_video_download, audio_download, output_base,
+                       temp_dir=None, original_temp_dir=None):
+        """Combine the original video with the generated content into final video.
+        
+        gen_video_download and audio_download are futures resolving to the
+        local paths of the generated video and audio, so their downloads can
+        still be running while the original video is probed. The remuxed copy
+        of the original goes to original_temp_dir, which should be on disk
+        since it is as large as the input.
+        """
         try:
-            print("\n5. Combining all components...")
-            # Download generated video and audio
-            gen_video_path = self.temp_dir / f"{output_base.stem}_generated.mp4"
-            audio_path = self.temp_dir / f"{output_base.stem}_audio.mp3"
-            
-            print("   Downloading generated video...")
-            self.download_file(generated_video_url, gen_video_path)
-            print("   Downloading generated audio...")
-            self.download_file(audio_url, audio_path)
+            self.log("\n5. Combining all components...")
+            temp_dir = Path(temp_dir) if temp_dir else self.temp_dir
+            original_temp_dir = Path(original_temp_dir) if original_temp_dir else temp_dir
+            for dir in [temp_dir, original_temp_dir]:
+                dir.mkdir(parents=True, exist_ok=True)
             
             # Get original video dimensions
-            cmd = [
-                'ffprobe',
-                '-v', 'error',
-                '-select_streams', 'v:0',
-                '-show_entries', 'stream=width,height',
-                '-of', 'json',
-                str(original_video_path)
-            ]
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            info = json.loads(result.stdout)
-            width = info['streams'][0]['width']
-            height = info['streams'][0]['height']
-            print(f"   Original video dimensions: {width}x{height}")
+            original_video = next(
+                s for s in self.probe_streams(original_video_path)
+                if s.get('codec_type') == 'video'
+            )
+            width = original_video['width']
+            height = original_video['height']
+            self.log(f"   Original video dimensions: {width}x{height}")
             
-            # First add audio to generated video
-            print("   Adding audio to generated video...")
-            gen_with_audio = self.temp_dir / f"{output_base.stem}_generated_with_audio.mp4"
-            cmd = [
-                'ffmpeg', '-y',
-                '-i', str(gen_video_path),
-                '-i', str(audio_path),
-                '-c:v', 'copy',  # Just copy video
-                '-c:a', 'aac',   # Convert audio to AAC
-                '-shortest',     # Match shortest duration
-                str(gen_with_audio)
-            ]
-            if not self.run_ffmpeg(cmd):
-                raise Exception("Failed to add audio to generated video")
-
-            # Add silent audio to original video if needed
-            print("   Processing original video...")
-            temp_original = self.temp_dir / f"{output_base.stem}_original_with_audio.mp4"
+            # The audio is needed by both intermediate muxes, so wait for it first
+            audio_path = audio_download.result()
+            
+            # MMAudio usually returns AAC already, which can be copied as-is
+            generated_audio = next(
+                (s for s in self.probe_streams(audio_path) if s.get('codec_type') == 'audio'),
+                {}
+            )
+            audio_codec = 'copy' if generated_audio.get('codec_name') == 'aac' else 'aac'
+            
+            # Add silent audio to original video if needed, using the generated
+            # audio's layout and sample rate so the final concat can stream-copy
+            self.log("   Processing original video...")
+            temp_original = original_temp_dir / f"{output_base.name}_original_with_audio.mp4"
+            channel_layout = generated_audio.get('channel_layout') or (
+                'stereo' if generated_audio.get('channels') == 2 else 'mono'
+            )
+            sample_rate = generated_audio.get('sample_rate') or 44100
             cmd = [
                 'ffmpeg', '-y',
                 '-i', str(original_video_path),
                 '-f', 'lavfi',
-                '-i', 'anullsrc=channel_layout=mono:sample_rate=44100',
+                '-i', f'anullsrc=channel_layout={channel_layout}:sample_rate={sample_rate}',
                 '-c:v', 'copy',
                 '-c:a', 'aac',
                 '-shortest',
                 str(temp_original)
             ]
-            if not self.run_ffmpeg(cmd):
+            original_process = self.start_ffmpeg(cmd)
+            
+            # Add audio to generated video while the original is being processed
+            gen_with_audio = temp_dir / f"{output_base.name}_generated_with_audio.mp4"
+            try:
+                gen_video_path = gen_video_download.result()
+                self.log("   Adding audio to generated video...")
+                cmd = [
+                    'ffmpeg', '-y',
+                    '-i', str(gen_video_path),
+                    '-i', str(audio_path),
+                    '-map', '0:v:0',
+                    '-map', '1:a:0',
+                    '-c:v', 'copy',        # Just copy video
+                    '-c:a', audio_codec,   # Copy AAC audio, convert anything else
+                    '-shortest',           # Match shortest duration
+                    str(gen_with_audio)
+                ]
+                generated_ok = self.run_ffmpeg(cmd)
+            finally:
+                original_ok = self.wait_ffmpeg(original_process)
+            if not generated_ok:
+                raise Exception("Failed to add audio to generated video")
+            if not original_ok:
                 raise Exception("Failed to process original video")
 
             # Now concatenate both videos
-            print("   Concatenating videos (this may take a few minutes)...")
-            output_path = self.output_dir / f"{output_base.stem}_final.mp4"
-            cmd = [
-                'ffmpeg', '-y',
-                '-i', str(temp_original),
-                '-i', str(gen_with_audio),
-                '-filter_complex',
-                f'[1:v]scale={width}:{height},setsar=1:1,fps=30[v1];[0:v]fps=30[v0];[v0][0:a][v1][1:a]concat=n=2:v=1:a=1[outv][outa]',
-                '-map', '[outv]',
-                '-map', '[outa]',
-                '-c:v', 'libx264',
-                '-preset', 'medium',
-                '-profile:v', 'high',
-                '-level:v', '4.0',
-                '-maxrate', '10M',
-                '-bufsize', '20M',
-                '-crf', '23',
-                '-g', '60',
-                '-c:a', 'aac',
-                '-b:a', '192k',
-                '-vsync', '2',  # Fix frame timing issues
-                '-movflags', '+faststart',
-                str(output_path)
-            ]
-            if not self.run_ffmpeg(cmd):
-                raise Exception("Failed to concatenate videos")
+            output_path = self.output_dir / f"{output_base.name}_final.mp4"
+            concat_list = temp_dir / f"{output_base.name}_concat.txt"
+            gen_normalized = temp_dir / f"{output_base.name}_generated_normalized.mp4"
+            if self.can_concat_without_reencoding(temp_original, gen_with_audio):
+                # Matching formats can be joined without decoding a single frame
+                self.log("   Concatenating videos (stream copy)...")
+                if not self.concat_videos([temp_original, gen_with_audio], output_path, concat_list):
+                    raise Exception("Failed to concatenate videos")
+            elif (self.normalize_for_concat(gen_with_audio, temp_original, gen_normalized)
+                    and self.can_concat_without_reencoding(temp_original, gen_normalized)):
+                # Only the short generated clip was re-encoded to match the original
+                self.log("   Concatenating videos (stream copy after normalizing generated video)...")
+                if not self.concat_videos([temp_original, gen_normalized], output_path, concat_list):
+                    raise Exception("Failed to concatenate videos")
+            else:
+                self.log("   Concatenating videos (this may take a few minutes)...")
+                # If the hardware encoder fails, retry once with libx264 so
+                # this last fallback can always finish
+                encoders = [self.h264_encoder] if self.h264_encoder == 'libx264' else [self.h264_encoder, 'libx264']
+                for encoder in encoders:
+                    cmd = [
+                        'ffmpeg', '-y',
+                        '-i', str(temp_original),
+                        '-i', str(gen_with_audio),
+                        '-filter_complex',
+                        f'[1:v]scale={width}:{height},setsar=1:1,fps=30[v1];[0:v]fps=30[v0];[v0][0:a][v1][1:a]concat=n=2:v=1:a=1[outv][outa]',
+                        '-map', '[outv]',
+                        '-map', '[outa]',
+                        *self.h264_encoder_args(encoder),
+                        *self.REENCODE_LIMIT_ARGS,
+                        '-g', '60',
+                        '-c:a', 'aac',
+                        '-b:a', '192k',
+                        '-vsync', '2',  # Fix frame timing issues
+                        '-movflags', self.output_movflags,
+                        str(output_path)
+                    ]
+                    if self.run_ffmpeg(cmd):
+                        break
+                    if encoder != 'libx264':
+                        self.log(f"   {encoder} failed, retrying with libx264...")
+                else:
+                    raise Exception("Failed to concatenate videos")
             
-            print("   Cleaning up temporary files...")
-            for file in [gen_video_path, audio_path, gen_with_audio, temp_original]:
+            self.log("   Cleaning up temporary files...")
+            for file in [gen_video_path, audio_path, gen_with_audio, gen_normalized, temp_original, concat_list]:
                 if file.exists():
                     file.unlink()
+            for dir in {temp_dir, original_temp_dir}:
+                if dir not in (self.temp_dir, self.local_temp_dir) and not any(dir.iterdir()):
+                    dir.rmdir()
             
             return output_path
             
         except Exception as e:
-            print(f"Error combining videos: {str(e)}")
+            self.log(f"Error combining videos: {str(e)}")
             return None
 
-    def process_video(self, input_video_path):
-        """Process the video through the entire pipeline."""
+    def output_names(self, videos):
+        """Pick a unique output name for each video.
+        
+        Outputs are named after the file stem, so videos that only differ by
+        extension (car.mp4 and car.mov) get the extension appended instead,
+        plus a counter if that still clashes with another video's name.
+        """
+        # Compare case-insensitively, since macOS and Windows filesystems are
+        stems = [Path(v).stem for v in videos]
+        counts = {}
+        for stem in stems:
+            counts[stem.lower()] = counts.get(stem.lower(), 0) + 1
+        taken = {stem.lower() for stem in stems if counts[stem.lower()] == 1}
+        
+        names = {}
+        for v, stem in sorted(zip(videos, stems), key=lambda item: str(item[0])):
+            if counts[stem.lower()] == 1:
+                names[v] = stem
+                continue
+            base = f"{stem}_{Path(v).suffix.lstrip('.').lower()}"
+            name, n = base, 2
+            while name.lower() in taken:
+                name = f"{base}_{n}"
+                n += 1
+            taken.add(name.lower())
+            names[v] = name
+        return names
+
+    def prepare_job(self, input_video_path, output_name=None):
+        """Extract the final frame and load any saved state for a video."""
         try:
-            print(f"\nDetailed processing steps for {input_video_path}:")
-            output_base = self.output_dir / Path(input_video_path).stem
+            self.log(f"\nDetailed processing steps for {input_video_path}:")
+            output_name = output_name or Path(input_video_path).stem
+            output_base = self.output_dir / output_name
+            
+            # Resume from whatever stages a previous run already completed.
+            # The state file is the only record kept between runs; load_state
+            # discards it if the input video has changed.
+            state_file = self.output_dir / f"{output_name}.state.json"
+            state = self.load_state(state_file, input_video_path)
+            complete = bool(state.get("final_video")) and Path(state["final_video"]).exists()
             
             # 1. Extract final frame
-            print("1. Extracting final frame...")
-            frame_path = self.extract_final_frame(input_video_path)
-            if not frame_path:
-                raise Exception("Failed to extract frame from video")
-            print(f"   Frame extracted to: {frame_path}")
+            if complete:
+                self.log(f"   Final video already exists for {Path(input_video_path).name}, skipping")
+                frame_path = self.output_dir / f"{output_name}_final_frame.jpg"
+            else:
+                self.log(f"1. Extracting final frame ({Path(input_video_path).name})...")
+                frame_path = self.extract_final_frame(input_video_path, output_name)
+                if not frame_path:
+                    raise Exception("Failed to extract frame from video")
+                self.log(f"   Frame extracted to: {frame_path}")
             
-            # Save processing details to a log file
-            log_file = output_base.with_suffix('.log')
-            with open(log_file, 'w') as f:
-                # 2. Analyze frame and generate scenario
-                print("2. Analyzing frame with Moondream...")
-                try:
-                    scenario = self.analyze_frame(frame_path)
-                    f.write(f"Generated scenario: {scenario}\n")
-                    print(f"   Scenario generated: {scenario}")
-                except Exception as e:
-                    print(f"   Error in Moondream analysis: {str(e)}")
-                    raise
-
-                # 3. Generate new video
-                print("3. Generating video with Replicate...")
-                try:
-                    generated_video_url = self.generate_video(frame_path, scenario)
-                    f.write(f"Generated video URL: {generated_video_url}\n")
-                    print(f"   Video generated: {generated_video_url}")
-                except Exception as e:
-                    print(f"   Error in video generation: {str(e)}")
-                    raise
-
-                # 4. Generate audio
-                print("4. Generating audio...")
-                try:
-                    audio_url = self.generate_audio(generated_video_url)
-                    f.write(f"Generated audio URL: {audio_url}\n")
-                    print(f"   Audio generated: {audio_url}")
-                except Exception as e:
-                    print(f"   Error in audio generation: {str(e)}")
-                    raise
-
-                # 5. Combine videos
-                print("5. Combining videos and audio...")
-                final_video_path = self.combine_videos(input_video_path, generated_video_url, audio_url, output_base)
+            job = {
+                "input_video_path": input_video_path,
+                "output_base": output_base,
+                "frame_path": frame_path,
+                "state_file": state_file,
+                "state": state,
+                "complete": complete,
+            }
+            return job
+        except Exception as e:
+            self.log(f"Error processing video {input_video_path}: {str(e)}")
+            return None
+
+    def analyze_stage(self, job):
+        """Generate (or reuse) the scenario for a prepared video."""
+        state = job["state"]
+        if job["complete"]:
+            return job
+        self.log(f"2. Analyzing frame with Moondream ({job['output_base'].name})...")
+        if state.get("scenario"):
+            self.log("   Reusing scenario from previous run")
+        else:
+            try:
+                state["scenario"] = self.analyze_frame(job["frame_path"])
+                self.save_state(job["state_file"], state)
+            except Exception as e:
+                self.log(f"   Error in Moondream analysis: {str(e)}")
+                return None
+        self.log(f"   Scenario generated: {state['scenario']}")
+        return job
+
+    def generate_video_stage(self, job, downloads):
+        """Generate (or reuse) the continuation video and start downloading it."""
+        state = job["state"]
+        if job["complete"]:
+            return job
+        self.log(f"3. Generating video with Replicate ({job['output_base'].name})...")
+        if state.get("generated_video_url") and self.url_is_available(state["generated_video_url"]):
+            self.log("   Reusing generated video from previous run")
+        else:
+            try:
+                state["generated_video_url"] = self.generate_video(job["frame_path"], state["scenario"])
+                # Audio generated for an older video no longer matches
+                state.pop("audio_url", None)
+                self.save_state(job["state_file"], state)
+            except Exception as e:
+                self.log(f"   Error in video generation: {str(e)}")
+                return None
+        self.log(f"   Video generated: {state['generated_video_url']}")
+        
+        # Use per-video temp directories so concurrent runs don't collide.
+        # They're reserved only now, so videos still waiting on the API don't
+        # hold RAM that earlier videos could be downloading into.
+        try:
+            self.reserve_scratch_dirs(job)
+        except OSError as e:
+            self.log(f"   Error preparing temp directory: {str(e)}")
+            return None
+        
+        # Download in the background so it overlaps with audio generation
+        self.log("   Downloading generated video in background...")
+        gen_video_path = job["temp_dir"] / f"{job['output_base'].name}_generated.mp4"
+        job["gen_video_download"] = downloads.submit(
+            self.download_file, state["generated_video_url"], gen_video_path
+        )
+        return job
+
+    def generate_audio_stage(self, job, downloads):
+        """Generate (or reuse) the audio track and start downloading it."""
+        state = job["state"]
+        if job["complete"]:
+            return job
+        self.log(f"4. Generating audio ({job['output_base'].name})...")
+        if state.get("audio_url") and self.url_is_available(state["audio_url"]):
+            self.log("   Reusing generated audio from previous run")
+        else:
+            try:
+                state["audio_url"] = self.generate_audio(state["generated_video_url"])
+                self.save_state(job["state_file"], state)
+            except Exception as e:
+                self.log(f"   Error in audio generation: {str(e)}")
+                return None
+        self.log(f"   Audio generated: {state['audio_url']}")
+        
+        self.log("   Downloading generated audio in background...")
+        audio_path = job["temp_dir"] / f"{job['output_base'].name}_audio.mp3"
+        job["audio_download"] = downloads.submit(
+            self.download_file, state["audio_url"], audio_path
+        )
+        return job
+
+    def combine_stage(self, job):
+        """Combine the original and generated content and return the video's results."""
+        state = job["state"]
+        try:
+            if job["complete"]:
+                final_video_path = state["final_video"]
+            else:
+                self.log(f"5. Combining videos and audio ({job['output_base'].name})...")
+                final_video_path = self.combine_videos(
+                    job["input_video_path"], job["gen_video_download"], job["audio_download"],
+                    job["output_base"], temp_dir=job["temp_dir"],
+                    original_temp_dir=job["original_temp_dir"]
+                )
+                self.release_scratch_dirs(job)
                 if final_video_path:
-                    f.write(f"Final video path: {final_video_path}\n")
-                    print(f"   Final video saved to: {final_video_path}")
+                    state["final_video"] = str(final_video_path)
+                    self.save_state(job["state_file"], state)
+                    self.log(f"   Final video saved to: {final_video_path}")
                 else:
-                    print("   Error: Failed to combine videos")
+                    self.log("   Error: Failed to combine videos")
 
             return {
-                "original_video": str(input_video_path),
-                "generated_video": generated_video_url,
-                "audio": audio_url,
-                "scenario": scenario,
-                "log_file": str(log_file),
+                "original_video": str(job["input_video_path"]),
+                "generated_video": state.get("generated_video_url"),
+                "audio": state.get("audio_url"),
+                "scenario": state.get("scenario"),
+                "state_file": str(job["state_file"]),
                 "final_video": str(final_video_path) if final_video_path else None
             }
-
         except Exception as e:
-            print(f"Error processing video: {str(e)}")
+            self.log(f"   Error combining {job['output_base'].name}: {str(e)}")
             return None
 
+    def process_video(self, input_video_path):
+        """Process the video through the entire pipeline."""
+        # Downloads run in the background so they overlap with audio
+        # generation and the FFmpeg probing in combine_videos
+        with ThreadPoolExecutor(max_workers=2) as downloads:
+            prepared = job = self.prepare_job(input_video_path)
+            if job:
+                job = self.analyze_stage(job)
+            if job:
+                job = self.generate_video_stage(job, downloads)
+            if job:
+                job = self.generate_audio_stage(job, downloads)
+            if job:
+                return self.combine_stage(job)
+        if prepared:
+            self.release_scratch_dirs(prepared)
+        return None
+
     def process_input_folder(self):
-        """Process all videos in the input folder."""
+        """Process all videos in the input folder as a staged pipeline."""
         supported_formats = ['.mp4', '.avi', '.mov', '.mkv']
-        results = []
+        videos = [f for f in self.input_dir.iterdir()
+                  if f.suffix.lower() in supported_formats]
+        if not videos:
+            return []
         
-        for video_file in self.input_dir.iterdir():
-            if video_file.suffix.lower() in supported_formats:
-                print(f"\nProcessing {video_file.name}...")
-                result = self.process_video(video_file)
-                if result:
-                    results.append(result)
-                    
+        # API stages wait on the network, so they get one thread per video;
+        # moondream_slots and replicate_slots still cap the requests in flight
+        api_workers = min(len(videos), 32)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as local_pool, \
+                ThreadPoolExecutor(max_workers=api_workers) as api_pool, \
+                ThreadPoolExecutor(max_workers=api_workers) as downloads:
+            # Frame extraction is local FFmpeg work, bounded by CPU count
+            names = self.output_names(videos)
+            jobs = [j for j in local_pool.map(self.prepare_job, videos, [names[v] for v in videos]) if j]
+            prepared = list(jobs)
+            
+            # Videos don't depend on each other, so each API stage is fanned
+            # out across the whole batch before moving on to the next one
+            jobs = [j for j in api_pool.map(self.analyze_stage, jobs) if j]
+            jobs = [j for j in api_pool.map(lambda j: self.generate_video_stage(j, downloads), jobs) if j]
+            jobs = [j for j in api_pool.map(lambda j: self.generate_audio_stage(j, downloads), jobs) if j]
+            
+            # Combining is FFmpeg work again
+            results = [r for r in local_pool.map(self.combine_stage, jobs) if r]
+        
+        # Videos dropped by a failed stage never reach combine_stage
+        for job in prepared:
+            self.release_scratch_dirs(job)
         return results
 
 def main():
     # Get API keys from environment variables
     MOONDREAM_API_KEY = os.getenv("MOONDREAM_API_KEY")
     REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
+    MAX_WORKERS = os.getenv("MAX_WORKERS")
+    REPLICATE_CONCURRENCY = os.getenv("REPLICATE_CONCURRENCY")
+    MOONDREAM_CONCURRENCY = os.getenv("MOONDREAM_CONCURRENCY")
+    FRAGMENTED_OUTPUT = os.getenv("FRAGMENTED_OUTPUT", "").lower() in ("1", "true", "yes")
     
     # Validate API keys
     if not MOONDREAM_API_KEY:
@@ -365,7 +949,14 @@ def main():
         return
         
     try:
-        processor = VideoProcessor(MOONDREAM_API_KEY, REPLICATE_API_TOKEN)
+        processor = VideoProcessor(
+            MOONDREAM_API_KEY,
+            REPLICATE_API_TOKEN,
+            max_workers=int(MAX_WORKERS) if MAX_WORKERS else None,
+            replicate_concurrency=int(REPLICATE_CONCURRENCY) if REPLICATE_CONCURRENCY else 5,
+            moondream_concurrency=int(MOONDREAM_CONCURRENCY) if MOONDREAM_CONCURRENCY else 2,
+            fragmented_output=FRAGMENTED_OUTPUT
+        )
         
         # Verify input directory has videos
         supported_formats = ['.mp4', '.avi', '.mov', '.mkv']
@@ -378,13 +969,18 @@ def main():
             return
             
         print(f"Found {len(video_files)} video(s) to process")
-        results = processor.process_input_folder()
+        if len(video_files) == 1:
+            # A single video gains nothing from the staged batch pipeline
+            result = processor.process_video(video_files[0])
+            results = [result] if result else []
+        else:
+            results = processor.process_input_folder()
         
         if results:
             print("\nProcessing completed successfully!")
             for result in results:
                 print(f"\nResults for {Path(result['original_video']).name}:")
-                print(f"Log file: {result['log_file']}")
+                print(f"State file: {result['state_file']}")
                 if result['final_video']:
                     print(f"Final video: {result['final_video']}")
         else: